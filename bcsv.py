@@ -1,5 +1,12 @@
+import functools
+import itertools
+import struct as _struct
 from btypes import *
 
+class FormatError(Exception): pass
+
+class OverlappingFieldsError(FormatError): pass
+
 cstring_sjis = CString('shift-jis')
 
 #------------------------------------------------------------------------------
@@ -11,6 +18,30 @@ SINT16 = 4
 SINT8 = 5
 STRING = 6
 
+FORMAT_CODES = {
+    UINT32 : 'L',
+    FLOAT32 : 'f',
+    SINT32 : 'l',
+    SINT16 : 'h',
+    SINT8 : 'b',
+    STRING : 'L'}
+
+FIELD_TYPES = {
+    UINT32 : uint32,
+    FLOAT32 : float32,
+    SINT32 : sint32,
+    SINT16 : sint16,
+    SINT8 : sint8,
+    STRING : uint32}
+
+DATA_SIZES = {
+    UINT32 : 4,
+    FLOAT32 : 4,
+    SINT32 : 4,
+    SINT16 : 2,
+    SINT8 : 1,
+    STRING : 4}
+
 
 class Header(Struct):
     entry_count = uint32
@@ -28,19 +59,7 @@ class Field(Struct):
 
     @property
     def data_size(self):
-        if self.data_type == UINT32:
-            return 4
-        elif self.data_type == FLOAT32:
-            return 4
-        elif self.data_type == SINT32:
-            return 4
-        elif self.data_type == SINT16:
-            return 2
-        elif self.data_type == SINT8:
-            return 1
-        elif self.data_type == STRING:
-            return 4
-            
+        return DATA_SIZES.get(self.data_type)
 
     def __init__(self,data_type,name,offset,mask,shift):
         self.data_type = data_type
@@ -55,16 +74,58 @@ class Field(Struct):
             self.name_hash = calculate_name_hash(name)
 
 
+@functools.lru_cache(maxsize=None)
 def calculate_name_hash(name):
+    # Iterating over the encoded name yields the character codes directly.
+    # Reducing modulo 2**32 commutes with the multiply-add, so the mask is
+    # only applied once at the end.
+    codes = name.encode('ascii') if name.isascii() else map(ord,name)
     h = 0
-    for c in name:
-        h = (h*31 + ord(c)) & 0xFFFFFFFF
-    return h
+    for c in codes:
+        h = h*31 + c
+    return h & 0xFFFFFFFF
 
 
 def create_name_table(names):
     return {calculate_name_hash(name) : name for name in names}
 
+
+def create_entry_layout(fields,entry_size,endianess):
+    """Create a struct describing a whole entry.
+
+    Returns the struct and a list of slots, one for each value in the struct.
+    A slot is a tuple of the indices of the fields stored at that offset, which
+    is more than one field only for UINT32 bit fields sharing a word.
+    """
+
+    groups = {}
+    for field_index,field in enumerate(fields):
+        if field.data_type not in FORMAT_CODES:
+            raise FormatError('invalid field data type')
+        groups.setdefault(field.offset,[]).append(field_index)
+
+    entry_format = endianess
+    position = 0
+    slots = []
+
+    for offset in sorted(groups):
+        slot = tuple(groups[offset])
+        field = fields[slot[0]]
+        if offset < position or (len(slot) > 1 and any(fields[i].data_type != UINT32 for i in slot)):
+            raise OverlappingFieldsError('overlapping fields')
+        if offset > position:
+            entry_format += '{}x'.format(offset - position)
+        entry_format += FORMAT_CODES[field.data_type]
+        position = offset + field.data_size
+        slots.append(slot)
+
+    if entry_size < position:
+        raise FormatError('invalid entry size')
+    if entry_size > position:
+        entry_format += '{}x'.format(entry_size - position)
+
+    return _struct.Struct(entry_format),slots
+
 #------------------------------------------------------------------------------
 
 class ListBase(list):
@@ -83,39 +144,45 @@ class ListBase(list):
         for field in fields:
             Field.pack(stream,field)
 
-        string_table = {}
-        string_pool = BytesStream(bytes(),stream.endianess)
-
-        for entry in entries:
-            entry_block = BytesStream(bytes(header.entry_size),stream.endianess)
-
-            for field_index,field in enumerate(fields):
-                value = cls.get_field_value(entry,field_index)
-                entry_block.seek(field.offset)
-
-                if field.data_type == UINT32:
-                    value = (value << field.shift) | uint32.unpack(entry_block)
-                    entry_block.seek(field.offset)
-                    uint32.pack(entry_block,value)
-                elif field.data_type == FLOAT32:
-                    float32.pack(entry_block,value)
-                elif field.data_type == SINT32:
-                    sint32.pack(entry_block,value)
-                elif field.data_type == SINT16:
-                    sint16.pack(entry_block,value)
-                elif field.data_type == SINT8:
-                    sint8.pack(entry_block,value)
-                elif field.data_type == STRING:
-                    if value in string_table:
-                        uint32.pack(entry_block,string_table[value])
-                    else:
-                        uint32.pack(entry_block,string_pool.tell())
-                        string_table[value] = string_pool.tell()
-                        cstring_sjis.pack(string_pool,value)
-
-            stream.write(entry_block.getvalue())
-
-        stream.write(string_pool.getvalue())
+        # Build the string pool up front, with each string encoded once, so
+        # that packing an entry only has to look up the offsets of its strings
+        string_fields = [field_index for field_index,field in enumerate(fields) if field.data_type == STRING]
+        strings = dict.fromkeys(cls.get_field_value(entry,field_index) for entry in entries for field_index in string_fields)
+        encoded_strings = [cstring_sjis.encode(string) for string in strings]
+        string_table = dict(zip(strings,itertools.accumulate(map(len,encoded_strings),initial=0)))
+
+        try:
+            entry_struct,slots = create_entry_layout(fields,header.entry_size,stream.endianess)
+        except OverlappingFieldsError:
+            # Fields overlapping other than as bit fields are written one after
+            # the other into a buffer for each entry, so that later fields
+            # overwrite earlier ones, except that UINT32 fields are combined
+            field_getters = [cls.create_slot_getter(fields,(field_index,),string_table) for field_index in range(len(fields))]
+            field_packers = [FIELD_TYPES[field.data_type].packers[stream.endianess] for field in fields]
+            entry_block = bytearray()
+            for entry in entries:
+                entry_buffer = bytearray(header.entry_size)
+                for field,get,packer in zip(fields,field_getters,field_packers):
+                    value = get(entry)
+                    if field.data_type == UINT32:
+                        value |= packer.unpack_from(entry_buffer,field.offset)[0]
+                    packer.pack_into(entry_buffer,field.offset,value)
+                entry_block += entry_buffer
+            stream.write(entry_block)
+            stream.write(b''.join(encoded_strings))
+            align(stream,0x20,b'\x40')
+            return
+
+        # The data type of each slot is fixed, so the dispatch on it is done
+        # once here rather than for every entry
+        slot_getters = [cls.create_slot_getter(fields,slot,string_table) for slot in slots]
+
+        # Pack all entries before writing, so that the stream only sees one
+        # write for the whole entry block
+        pack_entry = entry_struct.pack
+        stream.write(b''.join([pack_entry(*[get(entry) for get in slot_getters]) for entry in entries]))
+
+        stream.write(b''.join(encoded_strings))
         align(stream,0x20,b'\x40')
 
     @classmethod
@@ -124,37 +191,102 @@ class ListBase(list):
         fields = [Field.unpack(stream) for i in range(header.field_count)]
         entries = cls.create_list(header.entry_count,fields)
 
-        stream.seek(header.entry_offset + header.entry_count*header.entry_size)
-        string_pool = BytesStream(stream.read(),stream.endianess)
+        # Without entries there is nothing to check the fields against
+        if header.entry_count == 0:
+            return entries
 
+        # The entries and the string pool are each read with a single read and
+        # unpacked directly from the resulting bytes objects
         stream.seek(header.entry_offset)
+        entry_block = stream.read(header.entry_count*header.entry_size)
+        if len(entry_block) != header.entry_count*header.entry_size:
+            raise FormatError('unexpected end of entries')
+        string_pool = stream.read()
+
+        # Entries referring to the same offset in the string pool share one
+        # string object, so that repeated strings are only decoded once and
+        # are found by identity in the string table when packed again
+        string_table = {}
 
-        for entry in entries:
-            entry_block = BytesStream(stream.read(header.entry_size),stream.endianess)
-
+        try:
+            entry_struct,slots = create_entry_layout(fields,header.entry_size,stream.endianess)
+        except OverlappingFieldsError:
+            # Fields overlapping other than as bit fields can't be unpacked
+            # with one struct for the entry, so each field is unpacked on its
+            # own instead
+            if any(field.offset + field.data_size > header.entry_size for field in fields):
+                raise FormatError('invalid entry size')
             for field_index,field in enumerate(fields):
-                entry_block.seek(field.offset)
-
-                if field.data_type == UINT32:
-                    value = (uint32.unpack(entry_block) & field.mask) >> field.shift
-                elif field.data_type == FLOAT32:
-                    value = float32.unpack(entry_block)
-                elif field.data_type == SINT32:
-                    value = sint32.unpack(entry_block)
-                elif field.data_type == SINT16:
-                    value = sint16.unpack(entry_block)
-                elif field.data_type == SINT8:
-                    value = sint8.unpack(entry_block)
-                elif field.data_type == STRING:
-                    string_pool.seek(uint32.unpack(entry_block))
-                    value = cstring_sjis.unpack(string_pool)
-                else:
-                    raise FormatError('invalid field data type')
-              
-                cls.set_field_value(entry,field_index,value)
+                unpack_from = FIELD_TYPES[field.data_type].packers[stream.endianess].unpack_from
+                set_slot = cls.create_slot_setter(fields,(field_index,),string_table,string_pool)
+                for entry_index,entry in enumerate(entries):
+                    set_slot(entry,unpack_from(entry_block,entry_index*header.entry_size + field.offset)[0])
+            return entries
+
+        # An entry without fields or size has nothing to unpack, and iter_unpack
+        # doesn't accept a struct of size zero
+        if entry_struct.size == 0:
+            return entries
+
+        slot_setters = [cls.create_slot_setter(fields,slot,string_table,string_pool) for slot in slots]
+
+        for entry,values in zip(entries,entry_struct.iter_unpack(entry_block)):
+            for set_slot,value in zip(slot_setters,values):
+                set_slot(entry,value)
 
         return entries
 
+    @classmethod
+    def create_slot_getter(cls,fields,slot,string_table):
+        """Create a function returning the packed value of a slot of an entry."""
+
+        get_field_value = cls.get_field_value
+        field_index = slot[0]
+        data_type = fields[field_index].data_type
+
+        # A UINT32 slot holding a single unshifted field is packed like any
+        # other value, only bit fields sharing a word need to be combined
+        if data_type == UINT32 and (len(slot) > 1 or fields[field_index].shift != 0):
+            shifts = [(i,fields[i].shift) for i in slot]
+            def get(entry):
+                value = 0
+                for i,shift in shifts:
+                    value |= get_field_value(entry,i) << shift
+                return value
+        elif data_type == STRING:
+            def get(entry):
+                return string_table[get_field_value(entry,field_index)]
+        else:
+            def get(entry):
+                return get_field_value(entry,field_index)
+
+        return get
+
+    @classmethod
+    def create_slot_setter(cls,fields,slot,string_table,string_pool):
+        """Create a function storing the unpacked value of a slot in an entry."""
+
+        set_field_value = cls.set_field_value
+        field_index = slot[0]
+        data_type = fields[field_index].data_type
+
+        # Likewise, only bit fields need to be masked and shifted when unpacked
+        if data_type == UINT32 and (len(slot) > 1 or fields[field_index].mask != 0xFFFFFFFF or fields[field_index].shift != 0):
+            masks = [(i,fields[i].mask,fields[i].shift) for i in slot]
+            def set_slot(entry,value):
+                for i,mask,shift in masks:
+                    set_field_value(entry,i,(value & mask) >> shift)
+        elif data_type == STRING:
+            def set_slot(entry,value):
+                if value not in string_table:
+                    string_table[value] = cstring_sjis.unpack_from(string_pool,value)
+                set_field_value(entry,field_index,string_table[value])
+        else:
+            def set_slot(entry,value):
+                set_field_value(entry,field_index,value)
+
+        return set_slot
+
 #------------------------------------------------------------------------------
 
 class List(ListBase):
@@ -208,13 +340,19 @@ class ObjectListMeta(type):
     def __new__(metacls,cls,bases,classdict):
         objectlist_class = type.__new__(metacls,cls,bases,classdict)
         objectlist_class.bcsv_fields = classdict.bcsv_fields
+
+        # Entries only ever hold the fields, so they don't need a __dict__
+        if 'Entry' not in classdict:
+            objectlist_class.Entry = type('Entry',(),{
+                '__slots__' : tuple(field.attribute_name for field in classdict.bcsv_fields),
+                '__module__' : objectlist_class.__module__,
+                '__qualname__' : objectlist_class.__qualname__ + '.Entry'})
+
         return objectlist_class
 
 
 class ObjectList(ListBase,metaclass=ObjectListMeta):
 
-    class Entry: pass
-    
     @classmethod
     def create_list(cls,entry_count,fields):
         if fields != cls.bcsv_fields:
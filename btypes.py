@@ -1,6 +1,7 @@
 """Module for reading and writing data structures."""
 
 import io
+import operator
 import struct as _struct
 
 #------------------------------------------------------------------------------
@@ -10,12 +11,16 @@ class BasicType:
     def __init__(self,basic_format):
         self.basic_format = basic_format
         self.size = _struct.calcsize('=' + basic_format)
+        # Compiled once per endianess, so that packing doesn't have to parse
+        # the format string for every value
+        self.packers = {endianess : _struct.Struct(endianess + basic_format)
+                for endianess in (NATIVE_ENDIAN,LITTLE_ENDIAN,BIG_ENDIAN)}
 
     def pack(self,stream,value):
-        stream.write(_struct.pack(stream.endianess + self.basic_format,value))
+        stream.write(self.packers[stream.endianess].pack(value))
 
     def unpack(self,stream):
-        return _struct.unpack(stream.endianess + self.basic_format,stream.read(self.size))[0]
+        return self.packers[stream.endianess].unpack(stream.read(self.size))[0]
 
     def sizeof(self):
         return self.size
@@ -58,11 +63,26 @@ class Array:
         self.element_type = element_type
         self.length = length
 
+        # Arrays of basic types are packed with a single struct
+        if isinstance(element_type,BasicType):
+            self.packers = {endianess : _struct.Struct(endianess + str(length) + element_type.basic_format)
+                    for endianess in (NATIVE_ENDIAN,LITTLE_ENDIAN,BIG_ENDIAN)}
+        else:
+            self.packers = None
+
     def pack(self,stream,array):
+        if self.packers is not None:
+            stream.write(self.packers[stream.endianess].pack(*array))
+            return
+
         for value in array:
             self.element_type.pack(stream,value)
 
     def unpack(self,stream):
+        if self.packers is not None:
+            packer = self.packers[stream.endianess]
+            return list(packer.unpack(stream.read(packer.size)))
+
         return [self.element_type.unpack(stream) for _ in range(self.length)]
 
     def sizeof(self):
@@ -74,19 +94,54 @@ class CString:
     def __init__(self,encoding):
         self.encoding = encoding
         self.null = '\0'.encode(encoding)
+        self.chunk_size = 64*len(self.null)
 
     def pack(self,stream,string):
-        stream.write((string + '\0').encode(self.encoding))
+        stream.write(self.encode(string))
+
+    def encode(self,string):
+        return (string + '\0').encode(self.encoding)
 
     def unpack(self,stream):
         # NOTICE: This might not work for all encodings, but it works for
         # ascii, UTF-8, UTF-16 and Shift JIS.
-        string = b''
+
+        # Read the stream in chunks and search them for the terminating null,
+        # rather than reading one character at a time
+        null_size = len(self.null)
+        data = b''
+        start = 0
+
         while True:
-            c = stream.read(len(self.null))
-            if c == self.null: break
-            string += c
-        return string.decode(self.encoding)
+            chunk = stream.read(self.chunk_size)
+            if not chunk:
+                end = len(data) - len(data) % null_size
+                break
+            data += chunk
+
+            end = self.find_null(data,start)
+            if end != -1:
+                stream.seek(end + null_size - len(data),io.SEEK_CUR)
+                break
+
+            start = len(data) - len(data) % null_size
+
+        return data[:end].decode(self.encoding)
+
+    def unpack_from(self,data,offset=0):
+        """Unpack a string starting at offset in a bytes object."""
+        end = self.find_null(data,offset)
+        if end == -1:
+            end = len(data) - (len(data) - offset) % len(self.null)
+        return data[offset:end].decode(self.encoding)
+
+    def find_null(self,data,start):
+        # The terminating null has to be aligned to its own size relative to
+        # the start of the string, otherwise it is part of a character
+        end = data.find(self.null,start)
+        while end != -1 and (end - start) % len(self.null) != 0:
+            end = data.find(self.null,end + 1)
+        return end
 
     def sizeof(self):
         return None
@@ -163,10 +218,11 @@ class Pointer:
         return self.value_type.unpack(self.stream)
 
 
-def align(stream,boundary,padding='This is padding data to alignment.'):
+def align(stream,boundary,padding=b'This is padding data to alignment.'):
     if stream.tell() % boundary == 0: return
     n,r = divmod(boundary - (stream.tell() % boundary),len(padding))
-    stream.write(n*padding + padding[0:r])
+    if n: stream.write(n*padding)
+    if r: stream.write(padding[0:r])
 
 
 def align_length(length,boundary):
@@ -180,11 +236,13 @@ class Field:
         self.field_type = field_type
         self.name = name
 
-    def pack(self,stream,struct):
-        self.field_type.pack(stream,getattr(struct,self.name))
+    def set_value(self,struct,value):
+        setattr(struct,self.name,value)
 
-    def unpack(self,stream,struct):
-        setattr(struct,self.name,self.field_type.unpack(stream))
+    def struct_format(self):
+        if isinstance(self.field_type,BasicType):
+            return self.field_type.basic_format
+        return None
 
     def sizeof(self):
         return self.field_type.sizeof()
@@ -198,12 +256,16 @@ class Padding:
     def __init__(self,length,padding=b'\xFF'):
         self.length = length
         self.padding = padding
+        self.field_type = ByteString(length)
 
-    def pack(self,stream,struct):
-        stream.write(self.padding*self.length)
+    def get_value(self,struct):
+        return self.padding*self.length
 
-    def unpack(self,stream,struct):
-        stream.read(self.length)
+    def set_value(self,struct,value):
+        pass
+
+    def struct_format(self):
+        return '{}s'.format(self.length)
 
     def sizeof(self):
         return self.length
@@ -241,9 +303,33 @@ class StructMeta(type):
                 break
             struct_size += field.sizeof()
 
+        # Structs made up of only basic types and padding are packed with a
+        # single struct
+        struct_format = ''
+        for field in classdict.struct_fields:
+            if field.struct_format() is None:
+                struct_format = None
+                break
+            struct_format += field.struct_format()
+
+        if struct_format is not None:
+            struct_packers = {endianess : _struct.Struct(endianess + struct_format)
+                    for endianess in (NATIVE_ENDIAN,LITTLE_ENDIAN,BIG_ENDIAN)}
+        else:
+            struct_packers = None
+
+        # Getters for the values of the fields, in order. For fields these are
+        # attrgetters, which avoid a Python level call for each field
+        struct_getters = tuple(operator.attrgetter(field.name) if isinstance(field,Field) else field.get_value
+                for field in classdict.struct_fields)
+
         struct_class = type.__new__(metacls,cls,bases,classdict)
         struct_class.struct_fields = classdict.struct_fields
         struct_class.struct_size = struct_size
+        struct_class.struct_packers = struct_packers
+        struct_class.struct_getters = struct_getters
+        struct_class.struct_setters = tuple(field.set_value for field in classdict.struct_fields)
+        struct_class.struct_field_types = tuple(field.field_type for field in classdict.struct_fields)
         return struct_class
 
     def __init__(self,cls,bases,classdict):
@@ -259,14 +345,54 @@ class Struct(metaclass=StructMeta):
 
     @classmethod
     def pack(cls,stream,struct):
-        for field in cls.struct_fields:
-            field.pack(stream,struct)
+        if cls.struct_packers is not None:
+            packer = cls.struct_packers[stream.endianess]
+            stream.write(packer.pack(*[get(struct) for get in cls.struct_getters]))
+            return
+
+        for get,field_type in zip(cls.struct_getters,cls.struct_field_types):
+            field_type.pack(stream,get(struct))
+
+    @classmethod
+    def pack_list(cls,stream,structs):
+        # Pack a list of structs with a single write
+        if cls.struct_packers is not None:
+            pack = cls.struct_packers[stream.endianess].pack
+            getters = cls.struct_getters
+            stream.write(b''.join([pack(*[get(struct) for get in getters]) for struct in structs]))
+            return
+
+        for struct in structs:
+            cls.pack(stream,struct)
+
+    @classmethod
+    def pack_tuples(cls,stream,tuples):
+        # Pack a list of tuples of field values, in the order of the fields,
+        # with a single write. Padding has no value in the tuples.
+        if cls.struct_packers is not None and not any(isinstance(field,Padding) for field in cls.struct_fields):
+            pack = cls.struct_packers[stream.endianess].pack
+            stream.write(b''.join([pack(*values) for values in tuples]))
+            return
+
+        buffer = BytesStream(b'',stream.endianess)
+        for values in tuples:
+            values = iter(values)
+            for field,field_type in zip(cls.struct_fields,cls.struct_field_types):
+                field_type.pack(buffer,field.get_value(None) if isinstance(field,Padding) else next(values))
+        stream.write(buffer.getvalue())
 
     @classmethod
     def unpack(cls,stream):
         struct = cls.__new__(cls) #TODO: what if __init__ does something important?
-        for field in cls.struct_fields:
-            field.unpack(stream,struct)
+
+        if cls.struct_packers is not None:
+            packer = cls.struct_packers[stream.endianess]
+            for set_value,value in zip(cls.struct_setters,packer.unpack(stream.read(packer.size))):
+                set_value(struct,value)
+            return struct
+
+        for set_value,field_type in zip(cls.struct_setters,cls.struct_field_types):
+            set_value(struct,field_type.unpack(stream))
         return struct
 
     @classmethod
@@ -1,4 +1,7 @@
 import os
+import concurrent.futures
+import multiprocessing
+import multiprocessing.util
 import btypes
 import kcl
 
@@ -95,6 +98,38 @@ class GroupWidget(QtWidgets.QGroupBox):
 
 #------------------------------------------------------------------------------
 
+# Worker processes for the octree, kept in the builder process between builds.
+# The builder process runs threads for its own executor, so these are spawned
+# as well.
+octree_pool = kcl.OctreePool(multiprocessing.get_context('spawn'))
+
+# The builder process is a worker process itself, and joins its children on
+# exit before the executors would be shut down, so it would wait forever for
+# the octree workers. They are shut down by a finalizer instead, which has to
+# run before the finalizers of the queues of the executor, with exitpriority
+# 10, stop their feeder threads.
+multiprocessing.util.Finalize(None,octree_pool.shutdown,exitpriority=20)
+
+
+def build_collision(filename,triangles,max_triangles,min_width,surface_types):
+    with btypes.FileStream(filename,'wb',btypes.LITTLE_ENDIAN) as stream:
+        kcl.pack(stream,triangles,max_triangles,min_width,octree_pool)
+    with btypes.FileStream(os.path.splitext(filename)[0] + '.pa','wb',btypes.LITTLE_ENDIAN) as stream:
+        kcl.SurfaceTypeList.pack(stream,surface_types)
+
+
+# Building the collision is CPU bound, so it is done in a separate process
+# where it doesn't compete with the user interface for the GIL. The process is
+# spawned rather than forked, as forking the threaded user interface can
+# deadlock.
+def create_builder_executor():
+    return concurrent.futures.ProcessPoolExecutor(max_workers=1,
+            mp_context=multiprocessing.get_context('spawn'))
+
+
+builder_executor = create_builder_executor()
+
+
 class BuilderThread(QtCore.QThread):
 
     def __init__(self,parent,filename,triangles,max_triangles,min_width,surface_types):
@@ -108,13 +143,21 @@ class BuilderThread(QtCore.QThread):
     geometryOverflow = QtCore.pyqtSignal(kcl.GeometryOverflowError)
 
     def run(self):
+        global builder_executor
+
+        # The thread only waits for the builder process, so that the finished
+        # signal is still emitted when the build is done
         try:
-            with btypes.FileStream(self.filename[0],'wb',btypes.LITTLE_ENDIAN) as stream:
-                kcl.pack(stream,self.triangles,self.max_triangles,self.min_width)
-            with btypes.FileStream(os.path.splitext(self.filename[0])[0] + '.pa','wb',btypes.LITTLE_ENDIAN) as stream:
-                kcl.SurfaceTypeList.pack(stream,self.surface_types)
+            future = builder_executor.submit(build_collision,self.filename[0],self.triangles,
+                    self.max_triangles,self.min_width,self.surface_types)
+            future.result()
         except kcl.GeometryOverflowError as error:
             self.geometryOverflow.emit(error)
+        except concurrent.futures.process.BrokenProcessPool:
+            # The builder process died, e.g. when it ran out of memory. The
+            # executor can't be used again, so it is replaced for later builds
+            builder_executor = create_builder_executor()
+            raise
 
 
 class UnclosableProgressDialog(QtWidgets.QProgressDialog):
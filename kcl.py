@@ -5,8 +5,11 @@ See http://wiki.tockdom.com/wiki/KCL_%28File_Format%29 for a description of the
 MKW KCL file format.
 """
 
-from math import sqrt,log,ceil
-from collections import OrderedDict
+import os
+import concurrent.futures
+import struct as _struct
+from math import sqrt,frexp
+from operator import itemgetter
 from btypes import *
 import bcsv
 
@@ -62,16 +65,35 @@ def dot(a,b):
 def cross(a,b):
     return Vector(a.y*b.z - a.z*b.y,a.z*b.x - a.x*b.z,a.x*b.y - a.y*b.x)
 
+def unit_vector(x,y,z):
+    """Return Vector(x,y,z).unit(), without the intermediate vector."""
+    norm = sqrt(x*x + y*y + z*z)
+    return Vector(x/norm,y/norm,z/norm)
+
+def triangle_cross(u,v,w):
+    """Return the components of cross(v - u,w - u), without the intermediate vectors."""
+    p_x,p_y,p_z = v.x - u.x,v.y - u.y,v.z - u.z
+    q_x,q_y,q_z = w.x - u.x,w.y - u.y,w.z - u.z
+    return p_y*q_z - p_z*q_y,p_z*q_x - p_x*q_z,p_x*q_y - p_y*q_x
+
+def edge_normal(d_x,d_y,d_z,n):
+    """Return cross(d,n).unit() for the edge d = (d_x,d_y,d_z)."""
+    return unit_vector(d_y*n.z - d_z*n.y,d_z*n.x - d_x*n.z,d_x*n.y - d_y*n.x)
+
 
 class Triangle:
 
-    def __init__(self,u,v,w,group_index):
+    __slots__ = ('u','v','w','n','group_index')
+
+    def __init__(self,u,v,w,group_index,n=None):
         self.u = u
         self.v = v
         self.w = w
-        self.n = cross(v - u,w - u).unit()
         self.group_index = group_index
 
+        # The normal can be passed in if the caller already computed it
+        self.n = n if n is not None else unit_vector(*triangle_cross(u,v,w))
+
 
 class SurfaceType:
 
@@ -114,121 +136,231 @@ WALL_CODES = ['Normal','Not Wall Jump','Not Wall Slip','Not Grap',
 ###############################################################################
 
 class VertexWelder:
+    """Merges vertices that are closer than threshold in each coordinate.
 
-    # Three randomly chosen large primes
-    magic_x = 0x8DA6B343
-    magic_y = 0xD8163841
-    magic_z = 0x61B40079
+    Added vertices are put in a grid of cells, stored in a dictionary keyed by
+    the cell coordinates, so that only the cells within threshold of a new
+    vertex have to be searched.
 
-    def __init__(self,threshold,bucket_count):
+    If snap is true, vertices are only merged if they round to the same point
+    on a grid with spacing threshold. This is a single dictionary lookup per
+    vertex, but vertices closer than threshold on either side of a rounding
+    boundary are kept apart.
+    """
+
+    def __init__(self,threshold,*,snap=False):
         self.threshold = threshold
+        self.snap = snap
         self.cell_width = 16*threshold
-        self.buckets = [[] for _ in range(bucket_count)]
+        self.cells = {}
         self.vertices = []
 
-    def calculate_hash(self,ix,iy,iz):
-        return (ix*self.magic_x + iy*self.magic_y + iz*self.magic_z) % len(self.buckets)
-
     def add(self,vertex):
-        min_ix = int((vertex.x - self.threshold)/self.cell_width)
-        min_iy = int((vertex.y - self.threshold)/self.cell_width)
-        min_iz = int((vertex.z - self.threshold)/self.cell_width)
-        max_ix = int((vertex.x + self.threshold)/self.cell_width)
-        max_iy = int((vertex.y + self.threshold)/self.cell_width)
-        max_iz = int((vertex.z + self.threshold)/self.cell_width)
+        if self.snap:
+            return self.add_snapped(vertex)
+
+        x,y,z = vertex.x,vertex.y,vertex.z
+        threshold = self.threshold
+        cell_width = self.cell_width
+        cells = self.cells
+
+        min_ix = int((x - threshold)/cell_width)
+        min_iy = int((y - threshold)/cell_width)
+        min_iz = int((z - threshold)/cell_width)
+        max_ix = int((x + threshold)/cell_width)
+        max_iy = int((y + threshold)/cell_width)
+        max_iz = int((z + threshold)/cell_width)
 
         for ix in range(min_ix,max_ix + 1):
             for iy in range(min_iy,max_iy + 1):
                 for iz in range(min_iz,max_iz + 1):
-                    bucket = self.buckets[self.calculate_hash(ix,iy,iz)]
-                    for index in bucket:
-                        if (abs(vertex.x - self.vertices[index].x) < self.threshold and
-                                abs(vertex.y - self.vertices[index].y) < self.threshold and
-                                abs(vertex.z - self.vertices[index].z) < self.threshold):
+                    cell = cells.get((ix,iy,iz))
+                    if cell is None: continue
+                    for index,other_x,other_y,other_z in cell:
+                        if (abs(x - other_x) < threshold and
+                                abs(y - other_y) < threshold and
+                                abs(z - other_z) < threshold):
                             return index
 
+        index = len(self.vertices)
         self.vertices.append(vertex)
-        ix = int(vertex.x/self.cell_width)
-        iy = int(vertex.y/self.cell_width)
-        iz = int(vertex.z/self.cell_width)
-        bucket = self.buckets[self.calculate_hash(ix,iy,iz)]
-        bucket.append(len(self.vertices) - 1)
-        return len(self.vertices) - 1
+        key = (int(x/cell_width),int(y/cell_width),int(z/cell_width))
+        cells.setdefault(key,[]).append((index,x,y,z))
+        return index
+
+    def add_snapped(self,vertex):
+        threshold = self.threshold
+        key = (round(vertex.x/threshold),round(vertex.y/threshold),round(vertex.z/threshold))
+        index = self.cells.setdefault(key,len(self.vertices))
+        if index == len(self.vertices):
+            self.vertices.append(vertex)
+        return index
 
 ###############################################################################
 #                                   Octree
 ###############################################################################
 
+def ceil_log2(x):
+    """Return the smallest integer n such that 2**n >= x, for x > 0.
+
+    Unlike ceil(log(x,2)) this is exact, log can be off by a rounding error
+    for powers of two.
+    """
+    mantissa,exponent = frexp(x)
+    return exponent - 1 if mantissa == 0.5 else exponent
+
+
+def triangle_data(triangle):
+    """Return the data of a triangle in the form tribox_filter takes it.
+
+    This is a pair of the bounding box of the triangle and a flat tuple of the
+    corners, the normal and the edges, together with the sums of absolute
+    values that the separating axis tests scale by the half width of the cube.
+    All of these are the same for every cube the triangle is tested against.
+    """
+    u,v,w,n = triangle.u,triangle.v,triangle.w,triangle.n
+    bounds = (min(u.x,v.x,w.x),min(u.y,v.y,w.y),min(u.z,v.z,w.z),
+            max(u.x,v.x,w.x),max(u.y,v.y,w.y),max(u.z,v.z,w.z))
+
+    edges = []
+    edge_radii = []
+    for v0,v1 in ((u,v),(v,w),(w,u)):
+        e_x = v1.x - v0.x
+        e_y = v1.y - v0.y
+        e_z = v1.z - v0.z
+        edges += (e_x,e_y,e_z)
+        edge_radii += (abs(e_z) + abs(e_y),abs(e_z) + abs(e_x),abs(e_y) + abs(e_x))
+
+    return bounds,(u.x,u.y,u.z,v.x,v.y,v.z,w.x,w.y,w.z,
+            n.x,n.y,n.z,abs(n.x) + abs(n.y) + abs(n.z),*edges,*edge_radii)
+
+
 def tribox_overlap(triangle,center,half_width):
     """Intersection test for triangle and axis-aligned cube.
 
     Test if the triangle intersects the axis-aligned cube given by center and
-    half width. This algorithm is an adapted version of the algorithm presented
-    here:
+    half width. See tribox_filter.
+    """
+    return bool(tribox_filter([triangle_data(triangle)],(0,),(center.x,center.y,center.z),half_width))
+
+
+def tribox_filter(triangles,indices,center,half_width):
+    """Intersection test for triangles and axis-aligned cube.
+
+    Returns a tuple of the indices of the triangles that intersect the
+    axis-aligned cube given by center and half width. The triangles are given
+    in the form returned by triangle_data and the center as a tuple of its
+    coordinates. This algorithm is an adapted version of
+    the algorithm presented here:
     http://fileadmin.cs.lth.se/cs/Personal/Tomas_Akenine-Moller/code/tribox3.txt
     """
 
-    # The Vector subtraction operation is slow so we avoid using it here
-
-    u_x = triangle.u.x - center.x
-    u_y = triangle.u.y - center.y
-    u_z = triangle.u.z - center.z
-    v_x = triangle.v.x - center.x
-    v_y = triangle.v.y - center.y
-    v_z = triangle.v.z - center.z
-    w_x = triangle.w.x - center.x
-    w_y = triangle.w.y - center.y
-    w_z = triangle.w.z - center.z
-
-    # Test for separation along the axes normal to the faces of the cube
-    if ((u_x < -half_width and v_x < -half_width and w_x < -half_width) or
-            (u_x > half_width and v_x > half_width and w_x > half_width) or
-            (u_y < -half_width and v_y < -half_width and w_y < -half_width) or
-            (u_y > half_width and v_y > half_width and w_y > half_width) or
-            (u_z < -half_width and v_z < -half_width and w_z < -half_width) or
-            (u_z > half_width and v_z > half_width and w_z > half_width)):
-        return False
-
-    # Test for separation along the axis normal to the face of the triangle
-    n = triangle.n
-    d = n.x*u_x + n.y*u_y + n.z*u_z
-    r = half_width*(abs(n.x) + abs(n.y) + abs(n.z))
-    if d < -r or d > r:
-        return False
-
-    # Test for separation along the axes parallel to the cross products of the
-    # edges of the triangle and the edges of the cube
-
-    def edge_axis_test(a1,a2,b1,b2,c1,c2):
-        p = a1*b1 + a2*b2
-        q = a1*c1 + a2*c2
-        r = half_width*(abs(a1) + abs(a2))
-        return (p < -r and q < -r) or (p > r and q > r)
-
-    def edge_test(v0_x,v0_y,v0_z,v1_x,v1_y,v1_z,v2_x,v2_y,v2_z):
-        e_x = v1_x - v0_x
-        e_y = v1_y - v0_y
-        e_z = v1_z - v0_z
-        return (edge_axis_test(e_z,-e_y,v0_y,v0_z,v2_y,v2_z) or
-                edge_axis_test(-e_z,e_x,v0_x,v0_z,v2_x,v2_z) or
-                edge_axis_test(e_y,-e_x,v0_x,v0_y,v2_x,v2_y))
-
-    if (edge_test(u_x,u_y,u_z,v_x,v_y,v_z,w_x,w_y,w_z) or
-            edge_test(v_x,v_y,v_z,w_x,w_y,w_z,u_x,u_y,u_z) or
-            edge_test(w_x,w_y,w_z,u_x,u_y,u_z,v_x,v_y,v_z)):
-        return False
-
-    # Triangle and cube intersects
-    return True
+    # This is the inner loop of the octree construction, so everything is
+    # written out on local floats instead of using Vector or helper functions
+
+    c_x,c_y,c_z = center
+    hw = half_width
+    result = []
+
+    for i in indices:
+        bounds,data = triangles[i]
+        min_x,min_y,min_z,max_x,max_y,max_z = bounds
+
+        # Test for separation along the axes normal to the faces of the cube.
+        # This is done on the bounding box of the triangle, before any of the
+        # work below, with one comparison per side instead of one per corner.
+        # Rounding is monotonic, so subtracting the center from the bounds
+        # gives the same result as subtracting it from each corner.
+        if (max_x - c_x < -hw or min_x - c_x > hw or
+                max_y - c_y < -hw or min_y - c_y > hw or
+                max_z - c_z < -hw or min_z - c_z > hw):
+            continue
+
+        (t_ux,t_uy,t_uz,t_vx,t_vy,t_vz,t_wx,t_wy,t_wz,n_x,n_y,n_z,n_r,
+                e0_x,e0_y,e0_z,e1_x,e1_y,e1_z,e2_x,e2_y,e2_z,
+                r0_x,r0_y,r0_z,r1_x,r1_y,r1_z,r2_x,r2_y,r2_z) = data
+
+        u_x = t_ux - c_x
+        u_y = t_uy - c_y
+        u_z = t_uz - c_z
+        v_x = t_vx - c_x
+        v_y = t_vy - c_y
+        v_z = t_vz - c_z
+        w_x = t_wx - c_x
+        w_y = t_wy - c_y
+        w_z = t_wz - c_z
+
+        # Test for separation along the axis normal to the face of the triangle
+        d = n_x*u_x + n_y*u_y + n_z*u_z
+        r = hw*n_r
+        if d < -r or d > r:
+            continue
+
+        # Test for separation along the axes parallel to the cross products of
+        # the edges of the triangle and the edges of the cube. For each edge
+        # v0 -> v1, with v2 the opposite corner, v0 and v2 are projected onto
+        # the three axes e x (1,0,0), e x (0,1,0) and e x (0,0,1).
+
+        # Edge u -> v, opposite corner w
+        p = e0_z*u_y - e0_y*u_z
+        q = e0_z*w_y - e0_y*w_z
+        r = hw*r0_x
+        if (p < -r and q < -r) or (p > r and q > r): continue
+        p = e0_x*u_z - e0_z*u_x
+        q = e0_x*w_z - e0_z*w_x
+        r = hw*r0_y
+        if (p < -r and q < -r) or (p > r and q > r): continue
+        p = e0_y*u_x - e0_x*u_y
+        q = e0_y*w_x - e0_x*w_y
+        r = hw*r0_z
+        if (p < -r and q < -r) or (p > r and q > r): continue
+
+        # Edge v -> w, opposite corner u
+        p = e1_z*v_y - e1_y*v_z
+        q = e1_z*u_y - e1_y*u_z
+        r = hw*r1_x
+        if (p < -r and q < -r) or (p > r and q > r): continue
+        p = e1_x*v_z - e1_z*v_x
+        q = e1_x*u_z - e1_z*u_x
+        r = hw*r1_y
+        if (p < -r and q < -r) or (p > r and q > r): continue
+        p = e1_y*v_x - e1_x*v_y
+        q = e1_y*u_x - e1_x*u_y
+        r = hw*r1_z
+        if (p < -r and q < -r) or (p > r and q > r): continue
+
+        # Edge w -> u, opposite corner v
+        p = e2_z*w_y - e2_y*w_z
+        q = e2_z*v_y - e2_y*v_z
+        r = hw*r2_x
+        if (p < -r and q < -r) or (p > r and q > r): continue
+        p = e2_x*w_z - e2_z*w_x
+        q = e2_x*v_z - e2_z*v_x
+        r = hw*r2_y
+        if (p < -r and q < -r) or (p > r and q > r): continue
+        p = e2_y*w_x - e2_x*w_y
+        q = e2_y*v_x - e2_x*v_y
+        r = hw*r2_z
+        if (p < -r and q < -r) or (p > r and q > r): continue
+
+        # Triangle and cube intersects
+        result.append(i)
+
+    return tuple(result)
+
+
+# Offsets of the children of an octree node, in the order they are stored
+CHILD_OFFSETS = [(i,j,k) for k in range(2) for j in range(2) for i in range(2)]
 
 
 class Octree:
     """
-    Octree(triangles,max_triangles,min_width)
+    Octree(triangles,max_triangles,min_width,pool=None)
     
     Returns an octree where the cube of each leaf node intersects less than
     max_triangles of the triangles, unless that would make the width of the
-    cube less than min_width.
+    cube less than min_width. If an OctreePool is given, the top level nodes
+    of large octrees are built in its worker processes.
     """
 
     class Node:
@@ -239,23 +371,25 @@ class Octree:
             else:
                 return self.children[key[0] + 2*(key[1] + 2*key[2])]
 
-    def __init__(self,triangles,max_triangles,min_width):
+    def __init__(self,triangles,max_triangles,min_width,pool=None):
         self.triangles = triangles
         self.max_triangles = max_triangles
         self.min_width = min_width
 
-        min_x = min(min(t.u.x,t.v.x,t.w.x) for t in triangles)
-        min_y = min(min(t.u.y,t.v.y,t.w.y) for t in triangles)
-        min_z = min(min(t.u.z,t.v.z,t.w.z) for t in triangles)
-        max_x = max(max(t.u.x,t.v.x,t.w.x) for t in triangles)
-        max_y = max(max(t.u.y,t.v.y,t.w.y) for t in triangles)
-        max_z = max(max(t.u.z,t.v.z,t.w.z) for t in triangles)
+        # Flat copies of the triangles for the intersection tests
+        self.triangle_data = [triangle_data(triangle) for triangle in triangles]
+
+        # The bounding box is found from the bounding boxes of the triangles,
+        # iterating over the flat copies with itemgetter keeps the loops in C
+        triangle_bounds = [bounds for bounds,_ in self.triangle_data]
+        min_x,min_y,min_z = (min(map(itemgetter(k),triangle_bounds)) for k in range(0,3))
+        max_x,max_y,max_z = (max(map(itemgetter(k),triangle_bounds)) for k in range(3,6))
 
         # Base point and width of the bounding box
         self.base = Vector(min_x,min_y,min_z)
-        self.width_x = 2**int(ceil(log(max(max_x - min_x,min_width),2)))
-        self.width_y = 2**int(ceil(log(max(max_y - min_y,min_width),2)))
-        self.width_z = 2**int(ceil(log(max(max_z - min_z,min_width),2)))
+        self.width_x = 2**ceil_log2(max(max_x - min_x,min_width))
+        self.width_y = 2**ceil_log2(max(max_y - min_y,min_width))
+        self.width_z = 2**ceil_log2(max(max_z - min_z,min_width))
 
         # Width of the top level nodes
         self.base_width = min(self.width_x,self.width_y,self.width_z)
@@ -265,9 +399,25 @@ class Octree:
         self.ny = self.width_y//self.base_width
         self.nz = self.width_z//self.base_width
 
-        self.children = [self.node(self.base + self.base_width*Vector(i,j,k),self.base_width,range(len(triangles)))
+        # The base points of the nodes are plain tuples, the octree is built
+        # on floats and Vectors are only used for what is stored
+        bases = [(min_x + self.base_width*i,min_y + self.base_width*j,min_z + self.base_width*k)
                 for k in range(self.nz) for j in range(self.ny) for i in range(self.nx)]
 
+        if (pool is None or len(bases) == 1 or len(triangles) < PARALLEL_MIN_TRIANGLES or
+                (os.cpu_count() or 1) == 1):
+            self.children = build_nodes(self.triangle_data,max_triangles,min_width,self.base_width,bases)
+        else:
+            # The top level nodes don't depend on each other, so they are split
+            # in one contiguous run per processor and built in parallel. The
+            # workers already hold the triangle data, only the base points are
+            # sent with each run.
+            executor = pool.get_executor(self.triangle_data)
+            chunk_size = -(-len(bases)//(os.cpu_count() or 1))
+            futures = [executor.submit(build_worker_nodes,max_triangles,min_width,self.base_width,bases[i:i + chunk_size])
+                    for i in range(0,len(bases),chunk_size)]
+            self.children = [node for future in futures for node in future.result()]
+
         # If the top level branch ratio is greater than 0.875, space is saved
         # if the top level of nodes is removed
         while sum(1 for node in self.children if not node.is_leaf)/(self.nx*self.ny*self.nz) >= 0.875:
@@ -281,22 +431,34 @@ class Octree:
     def __getitem__(self,key):
         return self.children[key[0] + self.nx*(key[1] + self.ny*key[2])]
 
-    def node(self,base,width,indices):
-        node = Octree.Node()
-        half_width = width/2
-        center = base + Vector(half_width,half_width,half_width)
-        # Use tuple as it is hashable which is needed when packing
-        indices = tuple(i for i in indices if tribox_overlap(self.triangles[i],center,half_width))
-
-        if len(indices) > self.max_triangles and half_width >= self.min_width:
-            node.children = [self.node(base + half_width*Vector(i,j,k),half_width,indices)
-                    for k in range(2) for j in range(2) for i in range(2)]
-            node.is_leaf = False
-        else:
-            node.indices = indices
-            node.is_leaf = True
+    @staticmethod
+    def node(triangle_data,max_triangles,min_width,base,width,indices):
+        # The tree is built with an explicit stack of the nodes left to be
+        # subdivided instead of by recursion, saving a function call per node
+        root = Octree.Node()
+        stack = [(root,base,width,indices)]
+
+        # Equal index lists of leaves are made the same object, so that they
+        # can be merged by identity when packing
+        canonical = {}
+
+        while stack:
+            node,(b_x,b_y,b_z),width,indices = stack.pop()
+            half_width = width/2
+            center = (b_x + half_width,b_y + half_width,b_z + half_width)
+            # Use tuple as it is hashable which is needed when packing
+            indices = tribox_filter(triangle_data,indices,center,half_width)
+
+            if len(indices) > max_triangles and half_width >= min_width:
+                node.children = [Octree.Node() for i in range(8)]
+                node.is_leaf = False
+                stack.extend((child,(b_x + half_width*i,b_y + half_width*j,b_z + half_width*k),half_width,indices)
+                        for child,(i,j,k) in zip(node.children,CHILD_OFFSETS))
+            else:
+                node.indices = canonical.setdefault(indices,indices)
+                node.is_leaf = True
 
-        return node
+        return root
 
     @staticmethod
     def pack(stream,octree):
@@ -304,44 +466,123 @@ class Octree:
         # which is nothing but a terminating zero, uses the terminating zero of
         # the last non-empty list, thus saving a whopping two bytes. 
 
+        # The branches are packed in a single pass, breadth first. The offsets
+        # of the index lists are relative to the end of the branches, which is
+        # only known at the end, so the words of the leaves are first stored
+        # without it and fixed up afterwards. The words and the index lists
+        # are collected in lists of values and packed with a single struct.
         branches = [octree]
+        branch_base = 0
+        free_branch_offset = 4*len(octree.children)
         free_list_offset = 0
-        list_offsets = OrderedDict()
+        list_offsets = {}
+        words = []
+        values = []
+        leaf_positions = []
+        empty_leaf_positions = []
+
+        # Most leaves share their index list object with other leaves, so the
+        # offsets are also looked up by identity, and only index lists not seen
+        # before are hashed. Lists from different top level nodes can still
+        # be equal without being the same object.
+        offsets_by_id = {}
 
         i = 0
         while i < len(branches):
-            for node in branches[i].children:
+            branch = branches[i]
+            for node in branch.children:
                 if node.is_leaf:
-                    if not node.indices: continue
-                    if node.indices in list_offsets: continue
-                    list_offsets[node.indices] = free_list_offset
-                    free_list_offset += 2*(len(node.indices) + 1)
+                    indices = node.indices
+                    if not indices:
+                        empty_leaf_positions.append(len(words))
+                        words.append(-2 - branch_base)
+                        continue
+                    if id(indices) not in offsets_by_id:
+                        if indices not in list_offsets:
+                            list_offsets[indices] = free_list_offset
+                            free_list_offset += 2*(len(indices) + 1)
+                            values.extend([index + 1 for index in indices])
+                            values.append(0)
+                        offsets_by_id[id(indices)] = list_offsets[indices]
+                    leaf_positions.append(len(words))
+                    words.append(offsets_by_id[id(indices)] - 2 - branch_base)
                 else:
+                    words.append(free_branch_offset - branch_base)
+                    free_branch_offset += 4*len(node.children)
                     branches.append(node)
 
+            branch_base += 4*len(branch.children)
             i += 1
 
-        list_base = 4*sum(len(branch.children) for branch in branches)
-        list_offsets[tuple()] = free_list_offset - 2
-        branch_base = 0
-        free_branch_offset = 4*len(octree.children)
+        list_base = branch_base
+        for position in leaf_positions:
+            words[position] = 0x80000000 | (list_base + words[position])
+        for position in empty_leaf_positions:
+            words[position] = 0x80000000 | (list_base + free_list_offset - 2 + words[position])
 
-        for branch in branches:
-            for node in branch.children:
-                if node.is_leaf:
-                    uint32.pack(stream,0x80000000 | (list_base + list_offsets[node.indices] - 2 - branch_base))
-                else:
-                    uint32.pack(stream,free_branch_offset - branch_base)
-                    free_branch_offset += 4*len(node.children)
+        stream.write(_struct.pack('{}{}L'.format(stream.endianess,len(words)),*words))
+        stream.write(_struct.pack('{}{}H'.format(stream.endianess,len(values)),*values))
+
+
+def build_nodes(triangle_data,max_triangles,min_width,width,bases):
+    """Build the octree nodes of the given width at the given base points.
+
+    The base points are given as tuples of their coordinates. This is a module
+    level function so that it can be run in a worker process.
+    """
+    indices = range(len(triangle_data))
+    return [Octree.node(triangle_data,max_triangles,min_width,base,width,indices) for base in bases]
+
+#------------------------------------------------------------------------------
+
+# Below this number of triangles starting worker processes and sending them the
+# triangle data takes longer than building the octree
+PARALLEL_MIN_TRIANGLES = 0x4000
+
+
+def init_worker(triangle_data):
+    global worker_triangle_data
+    worker_triangle_data = triangle_data
 
-            branch_base += 4*len(branch.children)
 
-        del list_offsets[tuple()]
+def build_worker_nodes(max_triangles,min_width,width,bases):
+    """Build octree nodes from the triangle data of an OctreePool worker."""
+    return build_nodes(worker_triangle_data,max_triangles,min_width,width,bases)
 
-        for indices in list_offsets.keys():
-            for index in indices:
-                uint16.pack(stream,index + 1)
-            uint16.pack(stream,0)
+
+class OctreePool:
+    """Worker processes for building octrees in parallel.
+
+    The triangle data is sent to each worker once, when it is started. The
+    workers are kept between octrees and only restarted when the triangles
+    change, so building the octree of the same model again costs nothing
+    extra. The workers are stopped by shutdown, or on leaving a with block.
+    """
+
+    def __init__(self,mp_context=None):
+        self.mp_context = mp_context
+        self.executor = None
+        self.triangle_data = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.shutdown()
+
+    def get_executor(self,triangle_data):
+        if self.executor is None or triangle_data != self.triangle_data:
+            self.shutdown()
+            self.executor = concurrent.futures.ProcessPoolExecutor(mp_context=self.mp_context,
+                    initializer=init_worker,initargs=(triangle_data,))
+            self.triangle_data = triangle_data
+        return self.executor
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+            self.triangle_data = None
 
 ###############################################################################
 #                                  Collision
@@ -375,27 +616,36 @@ class Face(Struct):
     group_index = uint16
 
 
-def pack(stream,triangles,max_triangles,min_width):
-    """Write KCL file."""
+def pack(stream,triangles,max_triangles,min_width,pool=None):
+    """Write KCL file.
+
+    If an OctreePool is given, large octrees are built in it. See Octree.
+    """
 
     if len(triangles) >= 0xFFFF - 1:
         raise GeometryOverflowError('too many faces')
 
-    faces = [Face() for _ in triangles]
-    vertex_welder = VertexWelder(2**(-1),int(ceil(len(triangles)/64)))
-    normal_welder = VertexWelder(2**(-22),int(ceil(4*len(triangles)/64)))
-
-    for face,triangle in zip(faces,triangles):
-        a = cross(triangle.u - triangle.w,triangle.n).unit()
-        b = cross(triangle.v - triangle.u,triangle.n).unit()
-        c = cross(triangle.w - triangle.v,triangle.n).unit()
-        face.length = dot(triangle.v - triangle.u,c)
-        face.p_index = vertex_welder.add(triangle.u)
-        face.n_index = normal_welder.add(triangle.n)
-        face.a_index = normal_welder.add(a)
-        face.b_index = normal_welder.add(b)
-        face.c_index = normal_welder.add(c)
-        face.group_index = triangle.group_index
+    faces = []
+    vertex_welder = VertexWelder(2**(-1))
+    normal_welder = VertexWelder(2**(-22),snap=True)
+
+    # Vectors are only created for the values that are stored, the rest of the
+    # arithmetic is done on plain floats. The faces are kept as tuples of the
+    # values of the fields of Face, in order, and packed with Face.pack_tuples.
+    for triangle in triangles:
+        u,v,w,n = triangle.u,triangle.v,triangle.w,triangle.n
+        # Each edge is computed once, the edge from u to v is used twice
+        uv_x,uv_y,uv_z = v.x - u.x,v.y - u.y,v.z - u.z
+        a = edge_normal(u.x - w.x,u.y - w.y,u.z - w.z,n)
+        b = edge_normal(uv_x,uv_y,uv_z,n)
+        c = edge_normal(w.x - v.x,w.y - v.y,w.z - v.z,n)
+        faces.append((uv_x*c.x + uv_y*c.y + uv_z*c.z,
+                vertex_welder.add(u),
+                normal_welder.add(n),
+                normal_welder.add(a),
+                normal_welder.add(b),
+                normal_welder.add(c),
+                triangle.group_index))
 
     if len(vertex_welder.vertices) >= 0xFFFF:
         raise GeometryOverflowError('too many vertices')
@@ -407,28 +657,26 @@ def pack(stream,triangles,max_triangles,min_width):
     stream.write(b'\x00'*Header.sizeof())
 
     header.vertex_offset = stream.tell()
-    for vertex in vertex_welder.vertices:
-        Vector.pack(stream,vertex)
+    Vector.pack_list(stream,vertex_welder.vertices)
 
     header.normal_offset = stream.tell()
-    for normal in normal_welder.vertices:
-        Vector.pack(stream,normal)
+    Vector.pack_list(stream,normal_welder.vertices)
 
     header.face_offset = stream.tell() - Face.sizeof()
-    for face in faces:
-        Face.pack(stream,face)
+    Face.pack_tuples(stream,faces)
 
     header.octree_offset = stream.tell()
-    octree = Octree(triangles,max_triangles,min_width)
+    octree = Octree(triangles,max_triangles,min_width,pool)
     Octree.pack(stream,octree)
 
     header.base = octree.base
     header.x_mask = ~(octree.width_x - 1) & 0xFFFFFFFF
     header.y_mask = ~(octree.width_y - 1) & 0xFFFFFFFF
     header.z_mask = ~(octree.width_z - 1) & 0xFFFFFFFF
-    header.coordinate_shift = int(log(octree.base_width,2))
-    header.y_shift = int(log(octree.nx,2))
-    header.z_shift = header.y_shift + int(log(octree.ny,2))
+    # The widths and node counts are powers of two
+    header.coordinate_shift = octree.base_width.bit_length() - 1
+    header.y_shift = octree.nx.bit_length() - 1
+    header.z_shift = header.y_shift + octree.ny.bit_length() - 1
 
     stream.seek(0)
     Header.pack(stream,header)
@@ -452,27 +700,31 @@ class WavefrontOBJ(list):
         group_table = {'default group':0}
         group_index = 0
 
-        for line in stream:
-            if not line or line.isspace(): continue
-            command,*args = line.split()
+        # The file is read in one go, and each line is split once. Blank lines
+        # split into an empty list.
+        for fields in map(str.split,stream.read().split('\n')):
+            if not fields: continue
+            command = fields[0]
+
+            if command == 'v':
+                vertices.append(Vector(float(fields[1]),float(fields[2]),float(fields[3])))
 
-            if command == 'usemtl':
-                group_name = args[0] if args else 'default group'
+            elif command == 'f':
+                u = vertices[int(fields[1].partition('/')[0]) - 1]
+                v = vertices[int(fields[2].partition('/')[0]) - 1]
+                w = vertices[int(fields[3].partition('/')[0]) - 1]
+                x,y,z = triangle_cross(u,v,w)
+                if x*x + y*y + z*z < 0.001: continue # TODO: find a better solution
+                # The normal is the unit vector of the same cross product
+                triangles.append(Triangle(u,v,w,group_index,unit_vector(x,y,z)))
+
+            elif command == 'usemtl':
+                group_name = fields[1] if len(fields) > 1 else 'default group'
                 if group_name not in group_table:
                     group_table[group_name] = len(group_table)
                     triangles.group_names.append(group_name)
                 group_index = group_table[group_name]
 
-            elif command == 'v':
-                vertices.append(Vector(float(args[0]),float(args[1]),float(args[2])))
-
-            elif command == 'f':
-                u = vertices[int(args[0].split('/')[0]) - 1]
-                v = vertices[int(args[1].split('/')[0]) - 1]
-                w = vertices[int(args[2].split('/')[0]) - 1]
-                if cross(v - u,w - u).norm_square() < 0.001: continue # TODO: find a better solution
-                triangles.append(Triangle(u,v,w,group_index))
-
         return triangles
 
 #______________________________________________________________________________